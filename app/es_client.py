@@ -0,0 +1,32 @@
+import socket
+import ssl
+from typing import Tuple, Union
+
+import httpx
+
+KEEPALIVE_SOCKET_OPTIONS = [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+# Per-socket probe tuning is Linux-only (macOS lacks TCP_KEEPIDLE).
+if hasattr(socket, "TCP_KEEPIDLE"):
+    KEEPALIVE_SOCKET_OPTIONS += [
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3),
+    ]
+
+
+def make_es_client(
+        auth: Tuple[str, str], pool_size: int, timeout: float, verify: Union[ssl.SSLContext, bool]
+) -> httpx.Client:
+    transport = httpx.HTTPTransport(
+        verify=verify,
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        socket_options=KEEPALIVE_SOCKET_OPTIONS,
+    )
+    return httpx.Client(
+        auth=auth,
+        headers={"Accept-Encoding": "gzip"},
+        timeout=timeout,
+        transport=transport,
+    )
@@ -1,34 +1,72 @@
+import base64
+import binascii
 from dataclasses import dataclass
-from enum import Enum
 from http import HTTPStatus
-from typing import List, Optional
-from urllib.parse import urljoin
-
-import requests
-from flask import Flask, jsonify, request
-from wtforms import Form, IntegerField, SelectField, StringField, validators
+from ssl import create_default_context
+from typing import List, Optional, Tuple
+from urllib.parse import quote, urljoin
+
+import orjson
+import redis
+from flask import Flask, Response, jsonify, request
+from flask_caching import Cache
+from pydantic import BaseModel, Field, ValidationError, ValidationInfo, field_validator
+
+from app.es_client import make_es_client
+from app.movies_index import (
+    CACHE_KEY_PREFIX,
+    PRECOMPUTED_KEY,
+    PRECOMPUTED_LIMIT,
+    REDIS_URL,
+    SHORT_MOVIE_SOURCE_FIELDS,
+    SortField,
+    SortOrder,
+    build_sort_params,
+)
 
 app = Flask("movies_service")
 BASE_ES_URL = "https://localhost:9200"
+ES_CA_CERT = "http_ca.crt"
+# Upper bound of concurrent ES requests per process, keep gunicorn `threads` in line with it.
+ES_POOL_MAXSIZE = 32
+# Mirrors the index.max_result_window setting of the movies index.
+MAX_RESULT_WINDOW = 10000
+MAX_PAGE_SIZE = 250
 
 
 def dependency_mock_auth():
     return "elastic", "lolahaha12"
 
 
-@dataclass
+# One keep-alive HTTP/1.1 connection pool per process, shared by all request threads.
+CLIENT = make_es_client(
+    auth=dependency_mock_auth(),
+    pool_size=ES_POOL_MAXSIZE,
+    timeout=50,
+    verify=create_default_context(cafile=ES_CA_CERT),
+)
+REDIS = redis.Redis.from_url(REDIS_URL)
+cache = Cache(app, config={
+    "CACHE_TYPE": "RedisCache",
+    "CACHE_REDIS_URL": REDIS_URL,
+    "CACHE_KEY_PREFIX": CACHE_KEY_PREFIX,
+    "CACHE_DEFAULT_TIMEOUT": 120,
+})
+
+
+@dataclass(slots=True, frozen=True)
 class Actor:
     id: int
     name: str
 
     def to_dict(self) -> dict:
         return {
-            "id": int(self.id),
+            "id": self.id,
             "name": self.name,
         }
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Writers:
     id: str
     name: str
@@ -40,7 +78,7 @@ class Writers:
         }
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ShortMovie:
     id: str
     title: str
@@ -54,7 +92,7 @@ class ShortMovie:
         }
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Movie(ShortMovie):
     description: str
     genre: List[str]
@@ -64,7 +102,9 @@ class Movie(ShortMovie):
 
     def to_dict(self) -> dict:
         return {
-            **super().to_dict(),
+            "id": self.id,
+            "title": self.title,
+            "imdb_rating": self.imdb_rating,
             "description": self.description,
             "genre": self.genre,
             "actors": [a.to_dict() for a in self.actors],
@@ -73,55 +113,101 @@ class Movie(ShortMovie):
         }
 
 
-class SortOrder(Enum):
-    ASC = "asc"
-    DESC = "desc"
+MOVIE_SOURCE_FIELDS = [
+    "id", "title", "imdb_rating", "description", "genre", "actors", "writers", "director"
+]
 
 
-class SortField(Enum):
-    ID = "id"
-    TITLE = "title"
-    IMDB_RATING = "imdb_rating"
+def movie_from_source(movie_row: dict) -> Movie:
+    return Movie(
+        id=movie_row["id"],
+        title=movie_row["title"],
+        imdb_rating=movie_row["imdb_rating"],
+        description=movie_row["description"],
+        genre=movie_row["genre"],
+        actors=[Actor(**x) for x in movie_row["actors"]],
+        writers=[Writers(**x) for x in movie_row["writers"]],
+        directors=movie_row["director"]
+    )
 
 
+@cache.memoize(timeout=600)
 def get_movie_by_id(movie_id: str) -> Optional[Movie]:
-    request_data = {
-        "query": {
-            "term": {
-                "id": {
-                    "value": movie_id
-                }
-            }
-        }
-    }
-
-    response = requests.get(
-        url=urljoin(BASE_ES_URL, 'movies/_search'),
-        json=request_data,
-        headers={"Content-Type": "application/json"}
+    response = CLIENT.get(
+        url=urljoin(BASE_ES_URL, f"movies/_doc/{quote(movie_id, safe='')}"),
+        params={"_source_includes": ",".join(MOVIE_SOURCE_FIELDS)},
     )
 
-    if not response.ok:
-        response.raise_for_status()
+    if response.status_code == HTTPStatus.NOT_FOUND:
+        return None
+    response.raise_for_status()
 
-    data = response.json()
-    result = data["hits"]["hits"]
+    data = orjson.loads(response.content)
+    return movie_from_source(data["_source"])
 
-    if not result:
-        return None
 
-    movie_row = result[0]['_source']
-    movie = Movie(
-        id=movie_row["id"],
-        title=movie_row["title"],
-        imdb_rating=movie_row["imdb_rating"],
-        description=movie_row["description"],
-        genre=movie_row["genre"],
-        actors=[Actor(**x) for x in movie_row["actors"]],
-        writers=[Writers(**x) for x in movie_row["writers"]],
-        directors=movie_row["directors"]
+def get_movies_by_ids(ids: List[str]) -> List[Movie]:
+    response = CLIENT.post(
+        url=urljoin(BASE_ES_URL, "movies/_mget"),
+        json={"ids": ids},
+        params={"_source_includes": ",".join(MOVIE_SOURCE_FIELDS)},
     )
-    return movie
+
+    response.raise_for_status()
+
+    data = orjson.loads(response.content)
+    return [movie_from_source(doc["_source"]) for doc in data["docs"] if doc.get("found")]
+
+
+def encode_cursor(sort: SortField, sort_order: SortOrder, sort_values: list) -> str:
+    payload = {"sort": sort.value, "sort_order": sort_order.value, "after": sort_values}
+    return base64.urlsafe_b64encode(orjson.dumps(payload)).decode()
+
+
+def decode_cursor(cursor: str, sort: SortField, sort_order: SortOrder) -> list:
+    try:
+        # orjson rejects NaN/Infinity and over-deep nesting with JSONDecodeError, a ValueError.
+        payload = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        raise ValueError("Invalid cursor")
+    if (
+        not isinstance(payload, dict)
+        or payload.get("sort") != sort.value
+        or payload.get("sort_order") != sort_order.value
+    ):
+        raise ValueError("Cursor does not match sort and sort_order")
+
+    sort_values = payload.get("after")
+    if (
+        not isinstance(sort_values, list)
+        or len(sort_values) != len(build_sort_params(sort, sort_order))
+        or not all(
+            value is None or (isinstance(value, (str, int, float)) and not isinstance(value, bool))
+            for value in sort_values
+        )
+    ):
+        raise ValueError("Invalid cursor")
+    return sort_values
+
+
+def get_precomputed_page(
+        sort_order: SortOrder, sort: SortField, page: int, limit: int
+) -> Optional[Tuple[List[dict], Optional[str]]]:
+    key = PRECOMPUTED_KEY.format(sort=sort.value, order=sort_order.value)
+    start = (page - 1) * limit
+    try:
+        members = REDIS.zrange(key, start, start + limit - 1)
+    except redis.RedisError:
+        app.logger.exception("Failed to read precomputed page %s", key)
+        return None
+
+    # An empty range means the ETL has not filled the key, let ES answer.
+    if not members:
+        return None
+
+    records = [orjson.loads(member) for member in members]
+    next_cursor = encode_cursor(sort, sort_order, records[-1]["sort"])
+    return [record["movie"] for record in records], next_cursor
 
 
 def search_movies(
@@ -131,22 +217,24 @@ def search_movies(
         sort: SortField = SortField.ID,
         page: int = 1,
         limit: int = 50,
-) -> List[ShortMovie]:
-    sort_value = sort.value
-    if sort_value == SortField.TITLE.value:
-        sort_value = f"{SortField.TITLE.value}.raw"
+        search_after: Optional[list] = None,
+) -> Tuple[List[dict], Optional[str]]:
+    if not search_query and search_after is None and 0 < page * limit <= PRECOMPUTED_LIMIT:
+        precomputed = get_precomputed_page(sort_order=sort_order, sort=sort, page=page, limit=limit)
+        if precomputed is not None:
+            return precomputed
 
     request_data = {
         "size": limit,
-        "from": (page - 1) * limit,
-        "sort": [
-            {
-                sort_value: sort_order.value
-            }
-        ],
-        "_source": ["id", "title", "imdb_rating"],
+        "sort": build_sort_params(sort, sort_order),
+        "_source": SHORT_MOVIE_SOURCE_FIELDS,
     }
 
+    if search_after is not None:
+        request_data["search_after"] = search_after
+    else:
+        request_data["from"] = (page - 1) * limit
+
     if search_query:
         request_data["query"] = {
             "multi_match": {
@@ -163,89 +251,98 @@ def search_movies(
             }
         }
 
-    response = requests.get(
+    # httpx does not send bodies with GET, ES accepts the same search via POST.
+    response = CLIENT.post(
         url=urljoin(BASE_ES_URL, "movies/_search"),
         json=request_data,
-        headers={"Content-Type": "application/json"},
-        timeout=50,
-        auth=dependency_mock_auth(),
-        verify=False
     )
 
-    if not response.ok:
-        response.raise_for_status()
+    response.raise_for_status()
 
-    data = response.json()
+    data = orjson.loads(response.content)
     result = data["hits"]["hits"]
-    movies = []
+    # `_source` is already filtered down to the ShortMovie fields.
+    movies = [record["_source"] for record in result]
+    next_cursor = None
     if result:
-        for record in result:
-            movie_row = record["_source"]
-            movies.append(ShortMovie(
-                id=movie_row["id"],
-                title=movie_row["title"],
-                imdb_rating=movie_row["imdb_rating"]
-            ))
-    return movies
-
-
-class SearchMoviesValidator(Form):
-    limit = IntegerField("Limit", [validators.NumberRange(min=0)], default=50)
-    page = IntegerField("Page", [validators.NumberRange(min=1)], default=1)
-    search = StringField("Search", default="")
-    sort = SelectField(
-        "Sort",
-        choices=[
-            (SortField.ID.value, SortField.ID.value),
-            (SortField.TITLE.value, SortField.TITLE.value),
-            (SortField.IMDB_RATING.value, SortField.IMDB_RATING.value)
-        ],
-        default=SortField.ID.value,
-    )
-    sort_order = SelectField(
-        "SelectField",
-        choices=[
-            (SortOrder.ASC.value, SortOrder.ASC.value),
-            (SortOrder.DESC.value, SortOrder.DESC.value),
-        ],
-        default=SortOrder.ASC.value
-    )
-
-
-def validation_errors_to_dict(errors: dict) -> List[dict]:
-    validation_error = []
-    for field_name, field_errors in errors.items():
-        for err in field_errors:
-            validation_error.append(
-                {
-                    "loc": [
-                        "query",
-                        field_name,
-                    ],
-                    "msg": err
-                }
-            )
-    return validation_error
+        next_cursor = encode_cursor(sort, sort_order, result[-1]["sort"])
+    return movies, next_cursor
+
+
+class MoviesQuery(BaseModel):
+    limit: int = Field(50, ge=0, le=MAX_PAGE_SIZE)
+    search: str = ""
+    sort: SortField = SortField.ID
+    sort_order: SortOrder = SortOrder.ASC
+    # Declared after sort/sort_order and before page, the validators below read them from `info.data`.
+    # Holds the decoded search_after values of the `cursor` query argument.
+    cursor: Optional[list] = None
+    page: int = Field(1, ge=1)
+
+    @field_validator("cursor", mode="before")
+    @classmethod
+    def validate_cursor(cls, value: Optional[str], info: ValidationInfo) -> Optional[list]:
+        # Without a valid sort/sort_order the request is rejected by their own errors.
+        if not value or "sort" not in info.data or "sort_order" not in info.data:
+            return None
+        if not isinstance(value, str):
+            raise ValueError("Invalid cursor")
+        return decode_cursor(value, info.data["sort"], info.data["sort_order"])
+
+    @field_validator("page")
+    @classmethod
+    def validate_page(cls, value: int, info: ValidationInfo) -> int:
+        if info.data.get("cursor") is not None or "limit" not in info.data:
+            return value
+        if value * info.data["limit"] > MAX_RESULT_WINDOW:
+            raise ValueError(f"page * limit must not exceed {MAX_RESULT_WINDOW}, use cursor instead")
+        return value
 
 
 @app.route("/api/movies", methods=["GET"], strict_slashes=False)
+@cache.cached(query_string=True)
 def movies_list():
-    form = SearchMoviesValidator(request.args)
-    validation_errors = []
-    if not form.validate():
-        validation_errors = validation_errors_to_dict(form.errors)
-
-    if validation_errors:
+    try:
+        query = MoviesQuery.model_validate(request.args.to_dict())
+    except ValidationError as exc:
+        validation_errors = [
+            {
+                "loc": ["query", *err["loc"]],
+                "msg": err["msg"]
+            }
+            for err in exc.errors()
+        ]
         return jsonify(detail=validation_errors), HTTPStatus.UNPROCESSABLE_ENTITY
 
-    movies = search_movies(
-        search_query=form.search.data,
-        sort_order=SortOrder(form.sort_order.data),
-        sort=SortField(form.sort.data),
-        page=form.page.data,
-        limit=form.limit.data
+    movies, next_cursor = search_movies(
+        search_query=query.search,
+        sort_order=query.sort_order,
+        sort=query.sort,
+        page=query.page,
+        limit=query.limit,
+        search_after=query.cursor,
     )
-    return jsonify([m.to_dict() for m in movies])
+    response = Response(orjson.dumps(movies), mimetype="application/json")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
+
+
+@app.route("/api/movies/batch", methods=["GET"], strict_slashes=False)
+@cache.cached(query_string=True)
+def movies_batch():
+    ids = [movie_id for movie_id in request.args.get("ids", "").split(",") if movie_id]
+    if not ids:
+        validation_errors = [{"loc": ["query", "ids"], "msg": "Field required"}]
+        return jsonify(detail=validation_errors), HTTPStatus.UNPROCESSABLE_ENTITY
+    if len(ids) > MAX_PAGE_SIZE:
+        validation_errors = [
+            {"loc": ["query", "ids"], "msg": f"At most {MAX_PAGE_SIZE} ids are allowed"}
+        ]
+        return jsonify(detail=validation_errors), HTTPStatus.UNPROCESSABLE_ENTITY
+
+    movies = get_movies_by_ids(ids)
+    return Response(orjson.dumps([m.to_dict() for m in movies]), mimetype="application/json")
 
 
 if __name__ == '__main__':
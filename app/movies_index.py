@@ -0,0 +1,37 @@
+from enum import Enum
+from typing import List
+
+REDIS_URL = "redis://localhost:6379/0"
+# Prefix of the API response cache, etl_script.py drops every key under it after a reload.
+CACHE_KEY_PREFIX = "movies_api:"
+# etl_script.py stores the first PRECOMPUTED_LIMIT hits of every sort/order pair here.
+PRECOMPUTED_KEY = "movies:by_{sort}:{order}"
+PRECOMPUTED_LIMIT = 1000
+SHORT_MOVIE_SOURCE_FIELDS = ["id", "title", "imdb_rating"]
+
+
+class SortOrder(Enum):
+    ASC = "asc"
+    DESC = "desc"
+
+
+class SortField(Enum):
+    ID = "id"
+    TITLE = "title"
+    IMDB_RATING = "imdb_rating"
+
+
+def build_sort_params(sort: SortField, sort_order: SortOrder) -> List[dict]:
+    sort_value = sort.value
+    if sort_value == SortField.TITLE.value:
+        sort_value = f"{SortField.TITLE.value}.raw"
+
+    sort_params = [
+        {
+            sort_value: sort_order.value
+        }
+    ]
+    if sort != SortField.ID:
+        # `_id` has no doc values in ES 8, the keyword `id` field is the tiebreaker.
+        sort_params.append({SortField.ID.value: SortOrder.ASC.value})
+    return sort_params
@@ -1,64 +1,153 @@
-import json
+import io
 import logging
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import List
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional
 from urllib.parse import urljoin
 from ssl import create_default_context
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-context = create_default_context(cafile="http_ca.crt")
+import orjson
+import redis
 
-import requests
+from app.es_client import make_es_client
+from app.movies_index import (
+    CACHE_KEY_PREFIX,
+    PRECOMPUTED_KEY,
+    PRECOMPUTED_LIMIT,
+    REDIS_URL,
+    SHORT_MOVIE_SOURCE_FIELDS,
+    SortField,
+    SortOrder,
+    build_sort_params,
+)
 
-logger = logging.getLogger()
+context = create_default_context(cafile="http_ca.crt")
 
+logger = logging.getLogger()
 
-def dict_factory(cursor: sqlite3.Cursor, row: tuple) -> dict:
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+BULK_SIZE = 500
+# Only what the loader reads: the errors flag and, per item, the id and error.
+BULK_FILTER_PATH = 'errors,items.*._id,items.*.error'
+INGEST_PIPELINE = 'movies_clean'
+INGEST_PIPELINE_BODY = {
+    'description': "Drops 'N/A' sentinels and splits list fields of raw movie rows",
+    'processors': [
+        {
+            'script': {
+                'lang': 'painless',
+                'source': """
+                    if (ctx.imdb_rating == 'N/A') {
+                        ctx.imdb_rating = null;
+                    } else if (ctx.imdb_rating != null) {
+                        ctx.imdb_rating = Double.parseDouble(ctx.imdb_rating);
+                    }
+                    if (ctx.description == 'N/A') {
+                        ctx.description = null;
+                    }
+                    if (ctx.director == 'N/A') {
+                        ctx.director = null;
+                    } else if (ctx.director != null) {
+                        List directors = new ArrayList();
+                        for (String name : ctx.director.splitOnToken(',')) {
+                            directors.add(name.trim());
+                        }
+                        ctx.director = directors;
+                    }
+                    if (ctx.genre != null) {
+                        List genres = new ArrayList();
+                        for (String name : ctx.genre.replace(' ', '').splitOnToken(',')) {
+                            genres.add(name);
+                        }
+                        ctx.genre = genres;
+                    }
+                """,
+            }
+        }
+    ],
+}
 
 
 @contextmanager
 def conn_context(db_path: str):
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = dict_factory
-    yield conn
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    conn.execute('PRAGMA cache_size = -131072')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA mmap_size = 268435456')
+    try:
+        yield conn
+    finally:
+        conn.close()
 
 
 class ESLoader:
     def __init__(self, url: str, username, password):
         self.url = url
-        self.auth = (username, password)
+        self.client = make_es_client(auth=(username, password), pool_size=2, timeout=30, verify=context)
 
-    def __get_es_build_query(self, rows: List[dict], idx_name: str) -> List[str]:
-        prepared_query = []
-        for row in rows:
-            prepared_query.extend([
-                json.dumps({'index': {'_index': idx_name, '_id': row['id']}}),
-                json.dumps(row)
-            ])
-        return prepared_query
+    def put_pipeline(self, name: str, body: dict):
+        response = self.client.put(
+            urljoin(self.url, f'_ingest/pipeline/{name}'),
+            json=body,
+        )
+        response.raise_for_status()
+
+    def refresh(self, idx_name: str):
+        response = self.client.post(urljoin(self.url, f'{idx_name}/_refresh'))
+        response.raise_for_status()
 
-    def load_to_es(self, records: List[dict], idx_name: str):
-        prepared_query = self.__get_es_build_query(rows=records, idx_name=idx_name)
-        str_query = '\n'.join(prepared_query) + '\n'
+    def search(self, idx_name: str, body: dict) -> dict:
+        response = self.client.post(urljoin(self.url, f'{idx_name}/_search'), json=body)
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+    def __get_es_build_query(self, rows: List[dict], idx_name: str, pipeline: Optional[str]) -> bytes:
+        buffer = io.BytesIO()
+        for row in rows:
+            meta = {'_index': idx_name, '_id': row['id']}
+            if pipeline:
+                meta['pipeline'] = pipeline
+            buffer.write(orjson.dumps({'index': meta}) + b'\n')
+            buffer.write(orjson.dumps(row) + b'\n')
+        return buffer.getvalue()
 
-        response = requests.post(
+    def __load_chunk(self, rows: List[dict], idx_name: str, pipeline: Optional[str]):
+        response = self.client.post(
             urljoin(self.url, '_bulk'),
-            data=str_query,
+            params={'filter_path': BULK_FILTER_PATH},
+            content=self.__get_es_build_query(rows=rows, idx_name=idx_name, pipeline=pipeline),
             headers={'Content-Type': 'application/x-ndjson'},
-            auth=self.auth,
-            timeout=30,
-            verify=False
-
         )
-        print(response)
-        json_response = json.loads(response.content.decode())
-        print(json_response)
+        if not response.is_success:
+            logger.error('Bulk request failed with %s: %s', response.status_code, response.text[:1000])
+            response.raise_for_status()
+
+        json_response = orjson.loads(response.content)
+        if not json_response.get('errors'):
+            return
+        for item in json_response.get('items', ()):
+            error = item['index'].get('error')
+            if error:
+                logger.error('Failed to index %s: %s', item['index']['_id'], error)
+
+    def load_to_es(
+            self,
+            records: Iterable[dict],
+            idx_name: str,
+            bulk_size: int = BULK_SIZE,
+            pipeline: Optional[str] = None,
+    ):
+        records = iter(records)
+        # One sender thread: the next chunk is read and transformed while the previous one is in flight.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = None
+            while chunk := list(islice(records, bulk_size)):
+                if pending is not None:
+                    pending.result()
+                pending = executor.submit(self.__load_chunk, rows=chunk, idx_name=idx_name, pipeline=pipeline)
+            if pending is not None:
+                pending.result()
 
 
 class ETL:
@@ -69,70 +158,118 @@ class ETL:
     LEFT JOIN movie_actors ma on m.id = ma.movie_id
     LEFT JOIN actors a on ma.actor_id = a.id
     GROUP BY m.id
+    ),
+    mw as (
+    SELECT m.id as movie_id, wr.id as writer_id, wr.name as writer_name, min(je.key) as position
+    FROM movies m,
+    json_each(
+        CASE
+        WHEN m.writers = '' THEN json_array(json_object('id', m.writer))
+        ELSE m.writers
+        END
+    ) je
+    JOIN writers wr on wr.id = json_extract(je.value, '$.id')
+    WHERE wr.name != 'N/A'
+    GROUP BY m.id, wr.id
+    ORDER BY m.id, position
+    ),
+    w as (
+    SELECT movie_id, group_concat(writer_id) as writers_ids, group_concat(writer_name, char(31)) as writers_names
+    FROM mw
+    GROUP BY movie_id
     )
     SELECT m.id, genre, director, title, plot, imdb_rating, x.actors_ids, x.actors_names,
-    CASE
-    WHEN m.writers = '' THEN '[{"id": "' || m.writer || '"}]'
-    ELSE m.writers
-    END AS writers
+    w.writers_ids, w.writers_names
     FROM movies m
     LEFT JOIN x ON m.id = x.id
+    LEFT JOIN w ON m.id = w.movie_id
     """
 
     def __init__(self, conn: sqlite3.Connection, es_loader: ESLoader):
         self.es_loader = es_loader
         self.conn = conn
 
-    def load_writers_names(self) -> dict:
-        writers = {}
+    def __transform_row(self, row: tuple) -> dict:
+        (
+            movie_id, genre, director, title, plot, imdb_rating,
+            actors_ids, actors_names, writers_ids, writers_names,
+        ) = row
 
-        for writer in self.conn.execute("SELECT DISTINCT id, name FROM writers"):
-            writers[writer['id']] = writer
-        return writers
-
-    def __transform_row(self, row: dict, writers: dict) -> dict:
         movie_writers = []
-        writers_set = set()
-        for writer in json.loads(row['writers']):
-            writer_id = writer['id']
-            if writers[writer_id]['name'] != 'N/A' and writer_id not in writers_set:
-                movie_writers.append(writers[writer_id])
-                writers_set.add(writer_id)
+        writers_names_list = []
+        if writers_ids is not None:
+            # Writer names may contain commas, so they are joined with the unit separator.
+            writers_names_list = writers_names.split('\x1f')
+            movie_writers = [
+                {'id': _id, 'name': name}
+                for _id, name in zip(writers_ids.split(','), writers_names_list)
+            ]
         actors = []
-        actors_names = []
-        if row['actors_ids'] is not None and row['actors_names'] is not None:
+        if actors_ids is not None and actors_names is not None:
             actors = [
-                {'id': _id, 'name': name}
-                for _id, name in zip(row['actors_ids'].split(','), row['actors_names'].split(','))
+                {'id': int(_id), 'name': name}
+                for _id, name in zip(actors_ids.split(','), actors_names.split(','))
                 if name != 'N/A'
             ]
-            actors_names = [x for x in row['actors_names'].split(',') if x != 'N/A']
 
+        # genre, director, imdb_rating and description are normalized by the INGEST_PIPELINE.
         return {
-            'id': row['id'],
-            'genre': row['genre'].replace(' ', '').split(','),
+            'id': movie_id,
+            'genre': genre,
             'writers': movie_writers,
             'actors': actors,
-            'actors_names': actors_names,
-            'writers_names': [x['name'] for x in movie_writers],
-            'imdb_rating': float(row['imdb_rating']) if row['imdb_rating'] != 'N/A' else None,
-            'title': row['title'],
-            'director': [x.strip() for x in row['director'].split(',')] if row['director'] != 'N/A' else None,
-            'description': row['plot'] if row['plot'] != 'N/A' else None
+            'actors_names': [actor['name'] for actor in actors],
+            'writers_names': writers_names_list,
+            'imdb_rating': imdb_rating,
+            'title': title,
+            'director': director,
+            'description': plot
         }
 
+    def iter_records(self) -> Iterator[dict]:
+        # Rows are plain tuples in the fixed SELECT column order.
+        cursor = self.conn.execute(self.SQL)
+        while rows := cursor.fetchmany(BULK_SIZE):
+            for row in rows:
+                yield self.__transform_row(row=row)
+
     def load(self, idx_name: str):
-        records = []
+        self.es_loader.put_pipeline(name=INGEST_PIPELINE, body=INGEST_PIPELINE_BODY)
+        self.es_loader.load_to_es(records=self.iter_records(), idx_name=idx_name, pipeline=INGEST_PIPELINE)
+
+
+def invalidate_api_cache(redis_url: str = REDIS_URL):
+    client = redis.Redis.from_url(redis_url)
+    keys = list(client.scan_iter(match=f'{CACHE_KEY_PREFIX}*', count=1000))
+    if keys:
+        client.delete(*keys)
 
-        writers = self.load_writers_names()
 
-        for row in self.conn.execute(self.SQL):
-            transformed_row = self.__transform_row(row=row, writers=writers)
-            records.append(transformed_row)
-        self.es_loader.load_to_es(records=records, idx_name=idx_name)
+def precompute_top_pages(es_loader: ESLoader, idx_name: str, redis_url: str = REDIS_URL):
+    client = redis.Redis.from_url(redis_url)
+    es_loader.refresh(idx_name=idx_name)
+    for sort in SortField:
+        for order in SortOrder:
+            data = es_loader.search(idx_name=idx_name, body={
+                'size': PRECOMPUTED_LIMIT,
+                'sort': build_sort_params(sort, order),
+                '_source': SHORT_MOVIE_SOURCE_FIELDS,
+            })
+            members = {
+                orjson.dumps({'movie': hit['_source'], 'sort': hit['sort']}): rank
+                for rank, hit in enumerate(data['hits']['hits'])
+            }
+            key = PRECOMPUTED_KEY.format(sort=sort.value, order=order.value)
+            with client.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                if members:
+                    pipe.zadd(key, members)
+                pipe.execute()
 
 
 with conn_context('db.sqlite') as conn:
     es_loader = ESLoader("https://localhost:9200", 'elastic', 'lolahaha12')
     etl = ETL(conn=conn, es_loader=es_loader)
     etl.load(idx_name="movies")
+    precompute_top_pages(es_loader=es_loader, idx_name="movies")
+    invalidate_api_cache()
@@ -0,0 +1,8 @@
+import multiprocessing
+
+bind = "0.0.0.0:8000"
+worker_class = "gthread"
+workers = multiprocessing.cpu_count()
+# ES calls block on network I/O with the GIL released, so threads give
+# each worker concurrency. Matches ES_POOL_MAXSIZE in app/main.py.
+threads = 32